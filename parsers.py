@@ -1,150 +1,304 @@
-import requests, os, hashlib, logging
-from typing import List
+import requests, os, re, gzip, mmap, logging, asyncio
+import aiohttp
+import xxhash
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
+from typing import List, Tuple
 from urllib.parse import urlparse
-from abc import abstractmethod, ABCMeta
-from time import sleep
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from fake_useragent import UserAgent
 
 logger = logging.getLogger(__name__)
 
-class BaseArticleParser(metaclass=ABCMeta):
+_UA = UserAgent()
+
+def _make_session() -> requests.Session:
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections = 16,
+        pool_maxsize = 32,
+        max_retries = Retry(
+            total = 8,
+            backoff_factor = 0.5,
+            status_forcelist = [408, 429, 500, 502, 503, 504],
+            allowed_methods = ['GET'],
+            respect_retry_after_header = True
+        )
+    ))
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    return session
+
+_SESSION = _make_session()
+
+def _init_worker() -> None:
+    global _SESSION
+    _SESSION = _make_session()
+
+@lru_cache(maxsize = 4096)
+def _cache_id(href: str) -> str:
+    return xxhash.xxh3_64_hexdigest(href.encode('utf-8'))
+
+@lru_cache(maxsize = 256)
+def _resolve_subparser(parser_cls, href: str):
+    pattern = parser_cls._subparser_re()
+    match = pattern.search(href) if pattern is not None else None
+    if match is None:
+        return parser_cls
+    return parser_cls.subparsers[int(match.lastgroup[1:])][1]
+
+class BaseArticleParser:
 
     subparsers: List[str] = []
     blacklist: List[str] = []
 
-    @abstractmethod
-    def get_title(cls, soup: BeautifulSoup) -> str:
-        return
+    _tree_cache: 'OrderedDict' = OrderedDict()
+    _tree_cache_size = 128
 
-    @abstractmethod
-    def get_paragraphs(cls, soup: BeautifulSoup) -> str:
-        return
+    @classmethod
+    def _blacklist_re(cls):
+        if '_blacklist_pattern' not in cls.__dict__:
+            cls._blacklist_pattern = re.compile('|'.join(map(re.escape, cls.blacklist))) if cls.blacklist else None
+        return cls._blacklist_pattern
+
+    @classmethod
+    def is_blacklisted(cls, href: str) -> bool:
+        parser = cls.choose_subparser(href)
+        pattern = parser._blacklist_re()
+        return pattern is not None and pattern.search(href) is not None
 
     @classmethod
     def parse(cls, href: str) -> str:
-        soup = cls.get_soup(href)
         parser = cls.choose_subparser(href)
 
-        if any(x for x in parser.blacklist if x in href):
+        pattern = parser._blacklist_re()
+        if pattern is not None and pattern.search(href):
             raise BlacklistException
+
+        tree = cls.get_soup(href)
         try:
-            return ' '.join([parser.get_title(soup)] + parser.get_paragraphs(soup))
+            return parser.parse_tree(tree)
         except Exception as e:
             try:
-                return parser.try_subparsers(href)
+                return parser.try_subparsers(tree)
             except ArticleParseException as e:
                 raise e
 
     @classmethod
-    def try_subparsers(cls, href: str):
+    def parse_tree(cls, tree: LexborHTMLParser) -> str:
+        title, paragraphs = cls.get_article(tree)
+        if not paragraphs:
+            raise ArticleParseException
+        return ' '.join(chain((title,), paragraphs))
+
+    @classmethod
+    def try_subparsers(cls, tree: LexborHTMLParser):
         logger.debug(f'Parse failed using default parser: {cls.__name__}; trying additional parsers (if any) now...')
         for (identifier, subparser) in cls.subparsers:
             try:
-                return subparser.parse(href)
+                return subparser.parse_tree(tree)
             except:
                 logger.debug(f'Parse failed using {subparser.__name__}')
         raise ArticleParseException
 
+    @classmethod
+    def _subparser_re(cls):
+        if '_subparser_pattern' not in cls.__dict__:
+            cls._subparser_pattern = re.compile(
+                '|'.join(f'(?P<p{i}>{re.escape(identifier)})' for i, (identifier, _) in enumerate(cls.subparsers))
+            ) if cls.subparsers else None
+        return cls._subparser_pattern
+
     @classmethod
     def choose_subparser(cls, href: str):
-        try:
-            parser = min(
-                [(identifier, parser) for (identifier, parser) in cls.subparsers if identifier in href],
-                key = lambda p : href.find(p[0])
-            )[1]
+        parser = _resolve_subparser(cls, href)
+        if parser is not cls:
             logger.debug(f'Chosen parser for {href}: {parser.__name__}')
-            return parser
-        except ValueError as e:
-            return cls
+        return parser
 
     @classmethod
     def get_soup(cls, href):
+        tree = BaseArticleParser._tree_cache.get(href)
+        if tree is not None:
+            BaseArticleParser._tree_cache.move_to_end(href)
+            return tree
+
         content = cls._check_cache_for_content(href)
         if content is None:
-            ua = UserAgent()
-            resp = None
-            while resp == None or resp.status_code is not 200:
-                headers = {'User-Agent': ua.random}
-                resp = requests.get(href, headers = headers)
+            headers = {'User-Agent': _UA.random}
+            try:
+                resp = _SESSION.get(href, headers = headers, stream = True, timeout = (3.05, 30))
+                resp.raise_for_status()
                 logger.debug(f'Href: {href}; Response code: {resp.status_code}')
-                sleep(5)
 
-            cls._cache_content(href, resp.text)
-            return BeautifulSoup(resp.text, features = 'html.parser')
+                buffer = bytearray()
+                for chunk in resp.iter_content(chunk_size = 65536):
+                    buffer.extend(chunk)
+                content = bytes(buffer)
+            except requests.RequestException as e:
+                logger.debug(f'Fetch failed for {href}: {e}')
+                raise ArticleFetchException from e
+
+            cls._cache_content(href, content)
 
-        else:
-            return BeautifulSoup(content, features = 'html.parser')
+        tree = LexborHTMLParser(content)
+        BaseArticleParser._tree_cache[href] = tree
+        if len(BaseArticleParser._tree_cache) > cls._tree_cache_size:
+            BaseArticleParser._tree_cache.popitem(last = False)
+        return tree
+
+    @classmethod
+    def prefetch(cls, hrefs: List[str]) -> None:
+        hrefs = [href for href in hrefs if not cls.is_blacklisted(href) and not cls._is_cached(href)]
+        asyncio.run(cls._prefetch_all(hrefs))
+
+    @classmethod
+    async def _prefetch_all(cls, hrefs: List[str]) -> None:
+        semaphore = asyncio.Semaphore(64)
+        connector = aiohttp.TCPConnector(limit_per_host = 8)
+        async with aiohttp.ClientSession(connector = connector) as session:
+            await asyncio.gather(
+                *[cls._afetch(session, href, semaphore) for href in hrefs],
+                return_exceptions = True
+            )
+
+    @classmethod
+    async def _afetch(cls, session, href, semaphore):
+        async with semaphore:
+            headers = {'User-Agent': _UA.random}
+            for attempt in range(5):
+                async with session.get(href, headers = headers) as resp:
+                    logger.debug(f'Href: {href}; Response code: {resp.status}')
+                    if resp.status == 200:
+                        content = await resp.read()
+                        loop = asyncio.get_running_loop()
+                        await loop.run_in_executor(None, cls._cache_content, href, content)
+                        return
+                    elif resp.status in (429, 503):
+                        delay = float(resp.headers.get('Retry-After', 2 ** attempt))
+                    elif resp.status == 408 or resp.status >= 500:
+                        delay = 2 ** attempt
+                    else:
+                        logger.debug(f'Not retrying {href}: {resp.status}')
+                        return
+                await asyncio.sleep(delay)
+            logger.debug(f'Giving up on {href} after 5 attempts')
 
     @classmethod
     def _cache_content(cls, href, content):
-        cache_loc = f'.content_cache/{cls.get_cache_id(href)}.html'
-        logger.debug('Writing content to {cache_loc}')
-        with open(cache_loc, 'w+') as writer:
-            writer.write(str(content))
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        cache_loc = f'.content_cache/{cls.get_cache_id(href)}.html.gz'
+        logger.debug(f'Writing content to {cache_loc}')
+        compressed = gzip.compress(content)
+        try:
+            fd = os.open('.content_cache', os.O_TMPFILE | os.O_WRONLY, 0o644)
+        except (AttributeError, OSError):
+            cls._cache_content_fallback(cache_loc, compressed)
+            return
+        try:
+            os.write(fd, compressed)
+            try:
+                os.link(f'/proc/self/fd/{fd}', cache_loc)
+            except FileExistsError:
+                pass
+            except OSError:
+                cls._cache_content_fallback(cache_loc, compressed)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def _cache_content_fallback(cls, cache_loc, compressed):
+        tmp_loc = cache_loc + '.tmp'
+        with open(tmp_loc, 'wb') as writer:
+            writer.write(compressed)
+        os.replace(tmp_loc, cache_loc)
+
+    @classmethod
+    def _is_cached(cls, href):
+        cache_loc = f'.content_cache/{cls.get_cache_id(href)}.html.gz'
+        try:
+            return os.stat(cache_loc).st_size > 0
+        except FileNotFoundError:
+            return False
 
     @classmethod
     def _check_cache_for_content(cls, href):
-        cache_loc = f'.content_cache/{cls.get_cache_id(href)}.html'
-        if os.path.exists(cache_loc) and os.path.getsize(os.path.join(os.getcwd(), cache_loc)) > 0:
-            logger.debug(f'Reading content from {cache_loc}')
-            with open(cache_loc, 'r') as reader:
-                return reader.read()
-        else:
+        cache_loc = f'.content_cache/{cls.get_cache_id(href)}.html.gz'
+        try:
+            if os.stat(cache_loc).st_size == 0:
+                return None
+        except FileNotFoundError:
             return None
 
+        logger.debug(f'Reading content from {cache_loc}')
+        with open(cache_loc, 'rb') as reader:
+            os.posix_fadvise(reader.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            with mmap.mmap(reader.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                return gzip.decompress(mapped)
+
     @classmethod
     def _delete_content_from_cache(cls, href):
-        cache_loc = f'.content_cache/{cls.get_cache_id(href)}.html'
+        BaseArticleParser._tree_cache.pop(href, None)
+        cache_loc = f'.content_cache/{cls.get_cache_id(href)}.html.gz'
         logger.debug(f'Deleting content at {cache_loc}')
         os.remove(cache_loc)
 
     @classmethod
     def get_cache_id(cls, href):
-        return hashlib.md5(href.encode('utf-8')).hexdigest()
+        return _cache_id(href)
 
 class BBCThreeArticleParser(BaseArticleParser):
 
     blacklist = ['bbcthree/clip']
+    article_selector = 'h1.LongArticleParser-headline, div.LongArticleParser-body p'
 
     @classmethod
-    def get_title(cls, soup: BeautifulSoup) -> str:
-        title_element = soup.find('h1', {'class': 'LongArticleParser-headline'})
-        return title_element.text if title_element is not None else None
-
-    @classmethod
-    def get_paragraphs(cls, soup: BeautifulSoup) -> List[str]:
-        story_element_div = soup.find('div', {'class': 'LongArticleParser-body'})
-        story_elements = story_element_div.findAll('p')
-        return list(story_element.text for story_element in story_elements)
+    def get_article(cls, tree: LexborHTMLParser) -> Tuple[str, List[str]]:
+        title = None
+        paragraphs = []
+        for node in tree.css(cls.article_selector):
+            if node.tag == 'p':
+                paragraphs.append(node.text())
+            elif title is None:
+                title = node.text()
+        return title, paragraphs
 
 class BBCSportArticleParser(BaseArticleParser):
 
-    @classmethod
-    def get_title(cls, soup: BeautifulSoup) -> str:
-        title_element = soup.find('h1', {'class': 'story-headline'})
-        return title_element.text if title_element is not None else None
+    article_selector = 'h1.story-headline, div#story-body p'
 
     @classmethod
-    def get_paragraphs(cls, soup: BeautifulSoup) -> List[str]:
-        story_element_div = soup.find('div', {'id': 'story-body'})
-        story_elements = story_element_div.findAll('p')
-        return list(story_element.text for story_element in story_elements)
+    def get_article(cls, tree: LexborHTMLParser) -> Tuple[str, List[str]]:
+        title = None
+        paragraphs = []
+        for node in tree.css(cls.article_selector):
+            if node.tag == 'p':
+                paragraphs.append(node.text())
+            elif title is None:
+                title = node.text()
+        return title, paragraphs
 
 class BBCNewsroundArticleParser(BaseArticleParser):
 
-    @classmethod
-    def get_title(cls, soup: BeautifulSoup) -> str:
-        title_element = soup.find('h1', {'class': 'newsround-story-header__title-text'})
-        if title_element is None:
-            title_element = soup.find('h1', {'class': 'newsround-legacy-story-header__title-text'})
-        return title_element.text if title_element is not None else None
+    article_selector = ('h1.newsround-story-header__title-text, h1.newsround-legacy-story-header__title-text, '
+                        'section.newsround-story-body p, section.newsround-story-body span')
 
     @classmethod
-    def get_paragraphs(cls, soup: BeautifulSoup) -> List[str]:
-        story_element_div = soup.find('section', {'class': 'newsround-story-body'})
-        story_elements = story_element_div.findAll(['p', 'span'])
-        return list(story_element.text for story_element in story_elements)
+    def get_article(cls, tree: LexborHTMLParser) -> Tuple[str, List[str]]:
+        title = None
+        paragraphs = []
+        for node in tree.css(cls.article_selector):
+            if node.tag == 'h1':
+                if title is None:
+                    title = node.text()
+            else:
+                paragraphs.append(node.text())
+        return title, paragraphs
 
 class BBCArticleParser(BaseArticleParser):
 
@@ -158,47 +312,67 @@ class BBCArticleParser(BaseArticleParser):
                  'programmes', 'archive', 'ideas',
                  'food', 'sounds', 'news/av']
 
-    @classmethod
-    def get_title(cls, soup: BeautifulSoup) -> str:
-        title_element = soup.find('h1', {'class': 'story-body__h1'})
-        if title_element is None:
-            title_element = soup.find('span', {'class': 'cta'})
-        return title_element.text if title_element is not None else None
+    article_selector = 'h1.story-body__h1, span.cta, div.story-body__inner p'
 
     @classmethod
-    def get_paragraphs(cls, soup: BeautifulSoup) -> List[str]:
-        story_element_div = soup.find('div', {'class': 'story-body__inner'})
-        story_elements = story_element_div.findAll('p')
-        return list(story_element.text for story_element in story_elements)
+    def get_article(cls, tree: LexborHTMLParser) -> Tuple[str, List[str]]:
+        title = None
+        fallback_title = None
+        paragraphs = []
+        for node in tree.css(cls.article_selector):
+            if node.tag == 'p':
+                paragraphs.append(node.text())
+            elif node.tag == 'h1':
+                if title is None:
+                    title = node.text()
+            elif fallback_title is None:
+                fallback_title = node.text()
+        return (title if title is not None else fallback_title), paragraphs
 
 class GuardianArticleParser(BaseArticleParser):
 
-    @classmethod
-    def get_title(self, soup: BeautifulSoup) -> str:
-        title_element = soup.find('h1', {'class': 'content__headline '})
-        return title_element.text if title_element is not None else None
+    article_selector = 'h1.content__headline, div.content__main-column p'
 
     @classmethod
-    def get_paragraphs(self, soup: BeautifulSoup) -> List[str]:
-        story_element_div = soup.find('div', {'class': 'content__main-column'})
-        story_elements = story_element_div.findAll('p')
-        return list(story_element.text for story_element in story_elements)
+    def get_article(self, tree: LexborHTMLParser) -> Tuple[str, List[str]]:
+        title = None
+        paragraphs = []
+        for node in tree.css(self.article_selector):
+            if node.tag == 'p':
+                paragraphs.append(node.text())
+            elif title is None:
+                title = node.text()
+        return title, paragraphs
 
 class NYTimesArticleParser(BaseArticleParser):
 
-    @classmethod
-    def get_title(cls, soup: BeautifulSoup) -> str:
-        title_element = soup.find('span', {'class': 'balancedHeadline'})
-        return title_element.text if title_element is not None else None
+    article_selector = 'span.balancedHeadline, section[name="articleBody"] p'
 
     @classmethod
-    def get_paragraphs(cls, soup: BeautifulSoup) -> List[str]:
-        story_element_div = soup.find('section', {'name': 'articleBody'})
-        story_elements = story_element_div.findAll('p')
-        return list(story_element.text for story_element in story_elements)
+    def get_article(cls, tree: LexborHTMLParser) -> Tuple[str, List[str]]:
+        title = None
+        paragraphs = []
+        for node in tree.css(cls.article_selector):
+            if node.tag == 'p':
+                paragraphs.append(node.text())
+            elif title is None:
+                title = node.text()
+        return title, paragraphs
+
+def _parse_article(parser_name: str, href: str):
+    parser = globals()[parser_name]
+    try:
+        return ('ok', parser.parse(href))
+    except BlacklistException:
+        return ('blacklisted', None)
+    except ArticleParseException:
+        return ('error', None)
 
 class ArticleParseException(Exception):
     pass
 
+class ArticleFetchException(ArticleParseException):
+    pass
+
 class BlacklistException(Exception):
     pass
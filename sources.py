@@ -1,8 +1,11 @@
-import logging, requests
+import logging, os
 from bs4 import BeautifulSoup
+from lxml import html as lxml_html
 from typing import List
 from abc import abstractmethod, ABCMeta
-from parsers import BaseArticleParser, BBCArticleParser, GuardianArticleParser, NYTimesArticleParser, ArticleParseException, BlacklistException
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from parsers import BaseArticleParser, BBCArticleParser, GuardianArticleParser, NYTimesArticleParser, _SESSION, _parse_article, _init_worker
 
 logger = logging.getLogger(__name__)
 
@@ -21,31 +24,35 @@ class Source(metaclass=ABCMeta):
         articles = []
         erroneous_hrefs = []
 
-        hrefs = cls.get_hrefs()
+        hrefs = list(dict.fromkeys(cls.get_hrefs()))
+        cls.parser.prefetch(hrefs)
 
-        for href in hrefs:
-            try:
-                article = cls.parser.parse(href)
+        with ProcessPoolExecutor(max_workers = os.cpu_count(), initializer = _init_worker) as pool:
+            results = list(pool.map(_parse_article, repeat(cls.parser.__name__), hrefs, chunksize = 8))
+
+        for href, (status, article) in zip(hrefs, results):
+            if status == 'ok':
                 articles.append(article)
-            except ArticleParseException as e:
+            elif status == 'blacklisted':
+                logger.error(f'Blacklisted: {href}')
+            else:
                 logger.error(f'Could not parse article {href} using available {cls.__name__} parsers.')
                 erroneous_hrefs.append(href)
-            except BlacklistException as e:
-                logger.error(f'Blacklisted: {href}')
 
         cls._write_erroneous_article_hrefs(erroneous_hrefs)
         return articles
 
     @classmethod
     def _write_erroneous_article_hrefs(cls, hrefs: List[str]) -> None:
+        if not hrefs:
+            return
         with open(f'.failed_hrefs/{cls.__name__}', 'a') as writer:
-            for href in hrefs:
-                writer.write(href + '\n')
+            writer.writelines(href + '\n' for href in hrefs)
 
     @classmethod
     def _read_erroneous_article_hrefs(cls) -> List[str]:
-        with open(f'.failed_hrefs/{cls.__name__}','a') as reader:
-            return [str(href) for href in reader.read().split('\n')]
+        with open(f'.failed_hrefs/{cls.__name__}', 'r') as reader:
+            return reader.read().splitlines()
 
 class BBC(Source):
 
@@ -53,18 +60,17 @@ class BBC(Source):
 
     @classmethod
     def get_hrefs(cls) -> List[str]:
-        home_page = requests.get('https://www.bbc.co.uk')
-        soup = BeautifulSoup(home_page.content, features = 'html.parser')
-        article_elements = soup.findAll('a', {'class': 'top-story'})
-        return [element.get('href') for element in article_elements]
+        home_page = _SESSION.get('https://www.bbc.co.uk')
+        doc = lxml_html.fromstring(home_page.content)
+        return doc.xpath('//a[contains(concat(" ", normalize-space(@class), " "), " top-story ")]/@href')
 
 class Guardian(Source):
     parser = GuardianArticleParser
 
     @classmethod
     def get_hrefs(cls) -> List[str]:
-        home_page = requests.get('https://www.theguardian.com')
-        soup = BeautifulSoup(home_page.content)
+        home_page = _SESSION.get('https://www.theguardian.com')
+        soup = BeautifulSoup(home_page.content, features = 'lxml')
         article_elements = soup.findAll('a', {'class': 'fc-item__link'})
         return [element.get('href') for element in article_elements]
 
@@ -75,8 +81,8 @@ class NYTimes(Source):
     @classmethod
     def get_hrefs(cls) -> List[str]:
         home_page_url = 'https://www.nytimes.com'
-        home_page = requests.get(home_page_url)
-        soup = BeautifulSoup(home_page.content, features = 'html.parser')
+        home_page = _SESSION.get(home_page_url)
+        soup = BeautifulSoup(home_page.content, features = 'lxml')
         article_div = soup.find('main')
         article_elements = article_div.findAll('a')
         return [home_page_url+element.get('href').split('#')[0] for element in article_elements]